@@ -0,0 +1,30 @@
+#!/bin/bash
+# GCE startup script, run as root on every boot. The first boot installs the
+# NVIDIA driver and CUDA toolkit, then reboots so the driver loads. The next
+# boot checks the install and reports PROVISION_DONE (or PROVISION_FAILED) on
+# the serial console, which the driver script watches for.
+set -euo pipefail
+
+MARKER=/var/lib/provision-done
+
+trap 'echo PROVISION_FAILED > /dev/console' ERR
+
+if [ ! -f "$MARKER" ]; then
+    # apt-daily and unattended-upgrades often hold the apt/dpkg locks right
+    # after first boot, so every apt-get waits for them instead of failing.
+    # The keyring goes through apt-get rather than dpkg -i for the same reason.
+    wget -q https://developer.download.nvidia.com/compute/cuda/repos/ubuntu2204/x86_64/cuda-keyring_1.1-1_all.deb -O /tmp/cuda-keyring.deb
+    DEBIAN_FRONTEND=noninteractive apt-get -o DPkg::Lock::Timeout=600 install -y -qq /tmp/cuda-keyring.deb
+
+    DEBIAN_FRONTEND=noninteractive apt-get -o DPkg::Lock::Timeout=600 update -qq
+    DEBIAN_FRONTEND=noninteractive apt-get -o DPkg::Lock::Timeout=600 install -y -qq \
+        ubuntu-drivers-common nvidia-driver-535 gcc nvidia-cuda-toolkit
+
+    touch "$MARKER"
+    reboot
+    exit 0
+fi
+
+nvidia-smi > /dev/console
+nvcc --version > /dev/console
+echo PROVISION_DONE > /dev/console
@@ -1,18 +1,66 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+from pathlib import Path
 import re
 import sys
 from typing import Any
-import warnings
-import time
-import subprocess
 
+import google.api_core.exceptions
+import google.auth
+import google.auth.credentials
+import google.auth.exceptions
+import google.auth.transport.requests
+from google.api_core import retry, retry_async
 from google.api_core.extended_operation import ExtendedOperation
 from google.cloud import compute_v1
 
-
-def get_image_from_family(project: str, family: str) -> compute_v1.Image:
-    image_client = compute_v1.ImagesClient()
+# Keep this at or below the project's GPUS_ALL_REGIONS quota, otherwise the
+# extra regions fail with Forbidden until a slot frees up.
+MAX_CONCURRENT_REGIONS = 4
+
+# ServiceUnavailable from a zone is usually transient capacity pressure, so
+# creation is retried with backoff before the region is given up on.
+CREATE_RETRY = retry_async.AsyncRetry(
+    predicate=retry_async.if_exception_type(google.api_core.exceptions.ServiceUnavailable),
+    initial=2,
+    maximum=60,
+    timeout=300,
+)
+
+# A transient error while polling an operation's status says nothing about
+# the operation itself, so the poll is retried in place.
+OPERATION_POLL_RETRY = retry.Retry(
+    predicate=retry.if_transient_error,
+    initial=1,
+    maximum=10,
+    timeout=60,
+)
+
+# A single failed serial-port read (429/5xx) shouldn't end a long
+# provisioning wait, so transient errors are retried per read.
+SERIAL_PORT_RETRY = retry.Retry(
+    predicate=retry.if_transient_error,
+    initial=1,
+    maximum=30,
+    timeout=120,
+)
+
+MACHINE_TYPE_RE = re.compile(r"^zones/[a-z\d\-]+/machineTypes/[a-z\d\-]+$")
+
+# Passed to each VM as its startup-script, so provisioning starts on first
+# boot. After its reboot the script prints one of these to serial port 1.
+PROVISION_SCRIPT = Path(__file__).with_name("provision.sh").read_text()
+PROVISION_DONE = "PROVISION_DONE"
+PROVISION_FAILED = "PROVISION_FAILED"
+
+
+@functools.lru_cache
+def get_image_from_family(
+    project: str, family: str, credentials: google.auth.credentials.Credentials = None
+) -> compute_v1.Image:
+    image_client = compute_v1.ImagesClient(credentials=credentials)
     # List of public operating system (OS) images: https://cloud.google.com/compute/docs/images/os-details
     newest_image = image_client.get_from_family(project=project, family=family)
     return newest_image
@@ -25,25 +73,45 @@ def disk_from_image(
     source_image: str,
     auto_delete: bool = True,
 ) -> compute_v1.AttachedDisk:
-    
-    boot_disk = compute_v1.AttachedDisk()
-    initialize_params = compute_v1.AttachedDiskInitializeParams()
-    initialize_params.source_image = source_image
-    initialize_params.disk_size_gb = disk_size_gb
-    initialize_params.disk_type = disk_type
-    boot_disk.initialize_params = initialize_params
+
     # Remember to set auto_delete to True if you want the disk to be deleted when you delete
     # your VM instance.
-    boot_disk.auto_delete = auto_delete
-    boot_disk.boot = boot
-    return boot_disk
-
-
-def wait_for_extended_operation(
-    operation: ExtendedOperation, verbose_name: str = "operation", timeout: int = 300
+    return compute_v1.AttachedDisk(
+        initialize_params=compute_v1.AttachedDiskInitializeParams(
+            source_image=source_image,
+            disk_size_gb=disk_size_gb,
+            disk_type=disk_type,
+        ),
+        auto_delete=auto_delete,
+        boot=boot,
+    )
+
+
+async def wait_for_extended_operation(
+    operation: ExtendedOperation,
+    verbose_name: str = "operation",
+    timeout: int = 300,
+    poll_interval: float = 1,
+    max_poll_interval: float = 10,
 ) -> Any:
-   
-    result = operation.result(timeout=timeout)
+
+    # Check right away in case the operation is already done, then poll
+    # from the event loop so no thread is parked while we wait, backing off
+    # up to max_poll_interval between checks.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        while not await asyncio.to_thread(operation.done, retry=OPERATION_POLL_RETRY):
+            if loop.time() >= deadline:
+                raise TimeoutError(f"{verbose_name} did not finish within {timeout} seconds")
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+    except google.api_core.exceptions.RetryError as exc:
+        # Polling kept failing, so the operation may still succeed. Report it
+        # like a timeout so callers clean up instead of assuming it failed.
+        raise TimeoutError(f"could not poll {verbose_name}: {exc.cause}") from exc
+
+    result = operation.result()
 
     if operation.error_code:
         print(
@@ -62,7 +130,8 @@ def wait_for_extended_operation(
     return result
 
 
-def create_instance(
+async def create_instance(
+    instance_client: compute_v1.InstancesClient,
     project_id: str,
     zone: str,
     instance_name: str,
@@ -74,119 +143,276 @@ def create_instance(
     external_access: bool = False,
     external_ipv4: str = None,
     accelerators: list[compute_v1.AcceleratorConfig] = None,
-    preemptible: bool = False,
     spot: bool = False,
     instance_termination_action: str = "STOP",
     custom_hostname: str = None,
     delete_protection: bool = False,
-) -> compute_v1.Instance:
-    
-    instance_client = compute_v1.InstancesClient()
+    startup_script: str = None,
+) -> None:
 
     # Use the network interface provided in the network_link argument.
-    network_interface = compute_v1.NetworkInterface()
-    network_interface.network = network_link
-    if subnetwork_link:
-        network_interface.subnetwork = subnetwork_link
-
-    if internal_ip:
-        network_interface.network_i_p = internal_ip
-
+    access_configs = []
     if external_access:
-        access = compute_v1.AccessConfig()
-        access.type_ = compute_v1.AccessConfig.Type.ONE_TO_ONE_NAT.name
-        access.name = "External NAT"
-        access.network_tier = access.NetworkTier.PREMIUM.name
-        if external_ipv4:
-            access.nat_i_p = external_ipv4
-        network_interface.access_configs = [access]
-
-    # Collect information into the Instance object.
-    instance = compute_v1.Instance()
-    instance.network_interfaces = [network_interface]
-    instance.name = instance_name
-    instance.disks = disks
-
-    # Add GPU accelerator
-    gpu = compute_v1.AcceleratorConfig()
-    gpu.accelerator_type = f"projects/core-verbena-328218/zones/{zone}/acceleratorTypes/nvidia-l4"  # Specify the GPU accelerator type
-    gpu.accelerator_count = 1  # Specify the number of GPUs
-
-    instance.guest_accelerators = [gpu]
+        access_configs.append(
+            compute_v1.AccessConfig(
+                type_=compute_v1.AccessConfig.Type.ONE_TO_ONE_NAT.name,
+                name="External NAT",
+                network_tier=compute_v1.AccessConfig.NetworkTier.PREMIUM.name,
+                nat_i_p=external_ipv4,
+            )
+        )
+    network_interface = compute_v1.NetworkInterface(
+        network=network_link,
+        subnetwork=subnetwork_link,
+        network_i_p=internal_ip,
+        access_configs=access_configs,
+    )
+
+    # Default to a single L4 GPU unless accelerators are passed in.
+    if not accelerators:
+        accelerators = [
+            compute_v1.AcceleratorConfig(
+                accelerator_type=f"projects/{project_id}/zones/{zone}/acceleratorTypes/nvidia-l4",
+                accelerator_count=1,
+            )
+        ]
 
-    if re.match(r"^zones/[a-z\d\-]+/machineTypes/[a-z\d\-]+$", machine_type):
-        instance.machine_type = machine_type
-    else:
-        instance.machine_type = f"zones/{zone}/machineTypes/{machine_type}"
+    if not MACHINE_TYPE_RE.match(machine_type):
+        machine_type = f"zones/{zone}/machineTypes/{machine_type}"
 
-    instance.scheduling = compute_v1.Scheduling(
+    # GPU VMs can't live-migrate, so they must terminate on host maintenance.
+    scheduling = compute_v1.Scheduling(
         automatic_restart=True,
-        on_host_maintenance="TERMINATE"
-        )
-    
-    if accelerators:
-        instance.guest_accelerators = accelerators
-        instance.scheduling.on_host_maintenance = (
-            compute_v1.Scheduling.OnHostMaintenance.TERMINATE.name
-        )
-
-    if preemptible:
-        # Set the preemptible setting
-        warnings.warn(
-            "Preemptible VMs are being replaced by Spot VMs.", DeprecationWarning
-        )
-        instance.scheduling = compute_v1.Scheduling()
-        instance.scheduling.preemptible = True
+        on_host_maintenance=compute_v1.Scheduling.OnHostMaintenance.TERMINATE.name,
+    )
 
     if spot:
         # Set the Spot VM setting
-        instance.scheduling.provisioning_model = (
-            compute_v1.Scheduling.ProvisioningModel.SPOT.name
-        )
-        instance.scheduling.instance_termination_action = instance_termination_action
+        scheduling.provisioning_model = compute_v1.Scheduling.ProvisioningModel.SPOT.name
+        scheduling.instance_termination_action = instance_termination_action
 
-    if custom_hostname is not None:
-        # Set the custom hostname for the instance
-        instance.hostname = custom_hostname
+    metadata = None
+    if startup_script is not None:
+        metadata = compute_v1.Metadata(
+            items=[compute_v1.Items(key="startup-script", value=startup_script)]
+        )
 
-    if delete_protection:
-        # Set the delete protection bit
-        instance.deletion_protection = True
+    # Collect information into the Instance object.
+    instance = compute_v1.Instance(
+        name=instance_name,
+        disks=disks,
+        network_interfaces=[network_interface],
+        machine_type=machine_type,
+        guest_accelerators=accelerators,
+        scheduling=scheduling,
+        hostname=custom_hostname,
+        deletion_protection=delete_protection,
+        metadata=metadata,
+    )
 
     # Prepare the request to insert an instance.
-    request = compute_v1.InsertInstanceRequest()
-    request.zone = zone
-    request.project = project_id
-    request.instance_resource = instance
+    request = compute_v1.InsertInstanceRequest(
+        zone=zone, project=project_id, instance_resource=instance
+    )
 
     # Wait for the create operation to complete.
     print(f"Creating the {instance_name} instance in {zone}...")
 
-    operation = instance_client.insert(request=request)
-
-    wait_for_extended_operation(operation, "instance creation")
+    # Capacity errors can come back from the insert call itself or from the
+    # finished operation, so both are retried together. Neither leaves an
+    # instance behind, so a re-insert is only ever sent in those two cases.
+    attempts = 0
+
+    async def insert_and_wait() -> None:
+        nonlocal attempts
+        attempts += 1
+        operation = None
+        try:
+            operation = await asyncio.to_thread(instance_client.insert, request=request)
+            await wait_for_extended_operation(operation, "instance creation")
+
+        except google.api_core.exceptions.Conflict:
+            # On a retried attempt the name can only clash with our own VM: an
+            # earlier insert went through after all. Carry on as if this one
+            # did, so the caller provisions and deletes it.
+            if attempts == 1:
+                raise
+            print(f"#### {instance_name} was created by an earlier attempt ####")
+
+        except google.api_core.exceptions.ServiceUnavailable as exc:
+            # A 503 the operation did not report itself leaves the insert's
+            # fate unknown, so don't retry it; treat it like a timeout.
+            if operation is not None and not operation.error_code:
+                raise TimeoutError(f"instance creation state unknown: {exc}") from exc
+            raise
+
+    # on_error also runs for the attempt that exhausts the budget, so it must
+    # not promise another try. Once the budget is spent, AsyncRetry raises
+    # RetryError; re-raise the last ServiceUnavailable so callers see it.
+    try:
+        await CREATE_RETRY(
+            insert_and_wait,
+            on_error=lambda exc: print(f"#### No capacity in {zone}: {exc} ####"),
+        )()
+    except google.api_core.exceptions.RetryError as exc:
+        raise exc.cause from exc
 
     print(f"Instance {instance_name} created.")
-    return instance_client.get(project=project_id, zone=zone, instance=instance_name)
-
-def delete_instance(project_id, zone, instance_name):
-    compute_client = compute_v1.InstancesClient()
 
-    # Get the instance URL
-    instance_url = f"projects/{project_id}/zones/{zone}/instances/{instance_name}"
+async def delete_instance(instance_client, project_id, zone, instance_name):
 
     # Send the request to delete the instance
-    operation = compute_client.delete(project=project_id, zone=zone, instance=instance_name)
+    operation = await asyncio.to_thread(
+        instance_client.delete, project=project_id, zone=zone, instance=instance_name
+    )
 
     # Wait for the operation to complete
     print(f"Deleting instance {instance_name}...")
+    await wait_for_extended_operation(operation, "instance deletion")
     print(f"Instance {instance_name} deleted successfully.")
 
 
-if __name__ == "__main__":
-    import google.auth
-    import google.auth.exceptions
+async def wait_for_provisioning(
+    instance_client: compute_v1.InstancesClient,
+    project_id: str,
+    zone: str,
+    instance_name: str,
+    timeout: int = 1800,
+    poll_interval: float = 5,
+) -> bool:
+
+    # Tail the serial console from the last offset read. The previous chunk's
+    # end is kept so a marker split across two reads is still found.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    start = 0
+    contents = ""
+    while loop.time() < deadline:
+        output = await asyncio.to_thread(
+            instance_client.get_serial_port_output,
+            project=project_id,
+            zone=zone,
+            instance=instance_name,
+            port=1,
+            start=start,
+            retry=SERIAL_PORT_RETRY,
+        )
+        contents = contents[-len(PROVISION_FAILED):] + output.contents
+        if PROVISION_DONE in contents:
+            return True
+        if PROVISION_FAILED in contents:
+            return False
+        start = output.next_
+        await asyncio.sleep(poll_interval)
 
+    return False
+
+
+async def handle_region(
+    instance_client: compute_v1.InstancesClient,
+    project_id: str,
+    zone: str,
+    source_image: str,
+    semaphore: asyncio.Semaphore,
+) -> tuple[str, str]:
+    async with semaphore:
+        instance_name = "vm-" + zone
+
+        disk_type = f"zones/{zone}/diskTypes/pd-standard"
+        disks = [disk_from_image(disk_type, 20, True, source_image)]
+
+        try:
+            await create_instance(
+                instance_client,
+                project_id,
+                zone,
+                instance_name,
+                disks,
+                external_access=True,
+                startup_script=PROVISION_SCRIPT,
+            )
+
+        except google.api_core.exceptions.Forbidden:
+            print("#### GPU Exists in this region. Delete VM with that GPU first. ####")
+            return zone, "GPU already in use"
+
+        except google.api_core.exceptions.BadRequest:
+            print(f"#### GPU doesn't exist in region {zone}. Try another region ####")
+            return zone, "GPU not available"
+
+        except google.api_core.exceptions.ServiceUnavailable:
+            print(f"#### Region {zone} doesn't have the resources to fulfill request ####")
+            return zone, "no capacity"
+        
+        except google.api_core.exceptions.Conflict:
+            print(f"#### VM instance with this GPU already exists in {zone} ####")
+            return zone, "VM already exists"
+
+        except TimeoutError:
+            # The instance may still come up after we stop waiting, so try to
+            # delete it rather than leave a GPU VM behind.
+            print(f"#### Creating the VM in {zone} timed out, deleting it ####")
+            try:
+                await delete_instance(instance_client, project_id, zone, instance_name)
+            except Exception as exc:
+                print(f"#### Could not delete {instance_name}: {exc} ####", file=sys.stderr)
+            return zone, "creation timed out"
+
+        else:
+            print(f"#### GPU Successfully added in VM in region {zone} ####")
+            # Always release the VM and its GPU, even if the wait fails.
+            try:
+                provisioned = await wait_for_provisioning(
+                    instance_client, project_id, zone, instance_name
+                )
+            finally:
+                await delete_instance(instance_client, project_id, zone, instance_name)
+
+            if not provisioned:
+                return zone, "provisioning failed or timed out"
+            return zone, "provisioned"
+
+
+async def main(
+    project_id: str,
+    regions: list[str],
+    credentials: google.auth.credentials.Credentials,
+) -> None:
+    # Refresh once up front so concurrent regions don't race to fetch a token.
+    await asyncio.to_thread(credentials.refresh, google.auth.transport.requests.Request())
+
+    # One client and one image lookup shared by every region.
+    instance_client = compute_v1.InstancesClient(credentials=credentials)
+    newest_debian = await asyncio.to_thread(
+        get_image_from_family,
+        project="ubuntu-os-cloud",
+        family="ubuntu-2204-lts",
+        credentials=credentials,
+    )
+
+    # return_exceptions keeps one region's failure from cancelling the others
+    # mid-flight, which would leave their VMs running.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REGIONS)
+    results = await asyncio.gather(
+        *[
+            handle_region(instance_client, project_id, region, newest_debian.self_link, semaphore)
+            for region in regions
+        ],
+        return_exceptions=True,
+    )
+
+    print("#### Summary ####")
+    for region, result in zip(regions, results):
+        if isinstance(result, Exception):
+            print(f"{region}: failed with {type(result).__name__}: {result}")
+        else:
+            print(f"{region}: {result[1]}")
+
+
+if __name__ == "__main__":
+    # Every zone below is in a different region, so GCE bulkInsert (which
+    # only spreads a batch across the zones of one region) can't merge these
+    # into fewer requests; each zone gets its own insert.
     regions = [
         "northamerica-northeast1-a",
         "southamerica-east1-a",
@@ -200,8 +426,11 @@ if __name__ == "__main__":
         "us-west2-a"
     ]
 
+    default_project_id = "core-verbena-328218"
+
     try:
-        default_project_id = "core-verbena-328218"
+        # Resolved once here and shared by every client.
+        credentials, _ = google.auth.default()
     except google.auth.exceptions.DefaultCredentialsError:
         print(
             "Please use `gcloud auth application-default login` "
@@ -209,80 +438,4 @@ if __name__ == "__main__":
         )
     
     else:
-        for region in regions:
-            instance_zone = region
-            instance_name = "vm-" + instance_zone
-
-            newest_debian = get_image_from_family(
-                project="ubuntu-os-cloud", family="ubuntu-2204-lts"
-            )
-            disk_type = f"zones/{instance_zone}/diskTypes/pd-standard"
-            disks = [disk_from_image(disk_type, 20, True, newest_debian.self_link)]
-
-            try:
-                create_instance(default_project_id, instance_zone, instance_name, disks, external_access=True)
-
-            except google.api_core.exceptions.Forbidden:
-                print("#### GPU Exists in this region. Delete VM with that GPU first. ####")
-
-            except google.api_core.exceptions.BadRequest:
-                print(f"#### GPU doesn't exist in region {instance_zone}. Try another region ####")
-
-            except google.api_core.exceptions.ServiceUnavailable:
-                print(f"#### Region {instance_zone} doesn't have the resources to fulfill request ####")
-            
-            except google.api_core.exceptions.Conflict:
-                print(f"#### VM instance with this GPU already exists in {instance_zone} ####")
-
-            else:
-                print(f"#### GPU Successfully added in VM in region {instance_zone} ####")
-                compute_client = compute_v1.InstancesClient()
-                instance_details = compute_client.get(project=default_project_id, zone=instance_zone, instance=instance_name)
-
-                vm_instance_ip = instance_details.network_interfaces[0].access_configs[0].nat_i_p
-                vm_username = "Dell"
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} echo 'works'"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt update"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt upgrade"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt install ubuntu-drivers-common"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt install nvidia-driver-535"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo reboot now"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt install gcc"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} wget https://developer.download.nvidia.com/compute/cuda/repos/ubuntu2204/x86_64/cuda-keyring_1.1-1_all.deb"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo dpkg -i cuda-keyring_1.1-1_all.deb"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt-get update"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo reboot now"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} sudo apt install nvidia-cuda-toolkit"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} nvidia-smi"
-                subprocess.run(ssh_command, shell=True)
-
-                ssh_command = f"ssh -i id_rsa {vm_username}@{vm_instance_ip} nvcc --version"
-                subprocess.run(ssh_command, shell=True)
-
-                delete_instance(default_project_id, instance_zone, instance_name)
-                time.sleep(30)
\ No newline at end of file
+        asyncio.run(main(default_project_id, regions, credentials))